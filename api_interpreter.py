@@ -23,7 +23,10 @@ from plexe.vehicle_data import VehicleData
 from traci import FatalTraCIError
 
 from constants import TOPIC_API_RESPONSE
-from messages import APICallMessage, VehicleDataMessage, APIResponseMessage
+from messages import APICallMessage, VehicleDataMessage, APIResponseMessage, json_dumps, json_loads
+
+# APIs whose parameters are a VehicleDataMessage, passed as an object
+VDM_APIS = frozenset({PAR_LEADER_SPEED_AND_ACCELERATION, PAR_PRECEDING_SPEED_AND_ACCELERATION, PAR_CC_DESIRED_SPEED})
 
 
 class APIInterpreter:
@@ -32,6 +35,17 @@ class APIInterpreter:
     def __init__(self, traci, plexe):
         self.traci = traci
         self.plexe = plexe
+        # handlers for each supported API, so that serving a call only requires a single lookup
+        self.handlers = {
+            CC_PAR_VEHICLE_DATA: self.__get_vehicle_data,
+            PAR_LEADER_SPEED_AND_ACCELERATION: self.__set_leader_vehicle_data,
+            PAR_PRECEDING_SPEED_AND_ACCELERATION: self.__set_front_vehicle_data,
+            PAR_CC_DESIRED_SPEED: self.__set_cc_desired_speed,
+            PAR_ACTIVE_CONTROLLER: self.__set_active_controller,
+        }
+        # response topic and APIResponseMessage (as a dictionary) of each vehicle, indexed by sumo id. The response
+        # only needs the fields of the call being served to be updated before being serialized
+        self.response_templates = {}
 
     @staticmethod
     def __plexe_vehicle_data_to_mqtt(sumo_id, data):
@@ -41,42 +55,91 @@ class APIInterpreter:
     def __mqtt_to_plexe_vehicle_data(msg):
         return VehicleData(None, msg.controller_acceleration, msg.acceleration, msg.speed, msg.x, msg.y, msg.time)
 
+    def __get_vehicle_data(self, sumo_id, call_msg, msg):
+        data = self.plexe.get_vehicle_data(sumo_id)
+        result = self.__plexe_vehicle_data_to_mqtt(sumo_id, data)
+        # returned as a json string, as expected by all the clients of the vehicle data API
+        return result.to_json()
+
+    def __set_leader_vehicle_data(self, sumo_id, call_msg, msg):
+        data = self.__mqtt_to_plexe_vehicle_data(msg)
+        self.plexe.set_leader_vehicle_data(sumo_id, data)
+        return "true"
+
+    def __set_front_vehicle_data(self, sumo_id, call_msg, msg):
+        data = self.__mqtt_to_plexe_vehicle_data(msg)
+        self.plexe.set_front_vehicle_data(sumo_id, data)
+        return "true"
+
+    def __set_cc_desired_speed(self, sumo_id, call_msg, msg):
+        self.plexe.set_cc_desired_speed(sumo_id, msg.speed)
+        return "true"
+
+    def __set_active_controller(self, sumo_id, call_msg, msg):
+        controller = int(call_msg.parameters)
+        self.plexe.set_active_controller(sumo_id, controller)
+        return "true"
+
+    @staticmethod
+    def __parse_vehicle_data(parameters):
+        """ Parses the VehicleDataMessage passed as parameters of an API call
+        :param parameters: parameters of the API call, either as an object or as a json string
+        :return: the parsed message, or None if the parameters are not a valid VehicleDataMessage
+        """
+        # a new message for each call, so that no field can be left over from a previous call
+        msg = VehicleDataMessage()
+        try:
+            if isinstance(parameters, str):
+                parameters = json_loads(parameters)
+            if not isinstance(parameters, dict) or not msg.from_dict(parameters):
+                return None
+        except (ValueError, TypeError, KeyError):
+            # invalid json or content which is not an object. orjson errors are ValueError as well
+            return None
+        return msg
+
+    def __response_template(self, sumo_id):
+        template = self.response_templates.get(sumo_id)
+        if template is None:
+            response = APIResponseMessage(sumo_id)
+            template = (TOPIC_API_RESPONSE.format(sumo_id=sumo_id), response.to_object())
+            self.response_templates[sumo_id] = template
+        return template
+
     def serve_api_call(self, topic, payload):
+        """ Serves an API call received via MQTT
+        :param topic: topic the call has been received on
+        :param payload: json string of the APICallMessage
+        :return: tuple with the topic to publish the response on and the json string of the response, which is None if
+        the call could not be served
+        """
         _, sumo_id = topic.split("/")
-        response_topic = TOPIC_API_RESPONSE.format(sumo_id=sumo_id)
+        response_topic, response = self.__response_template(sumo_id)
         call_msg = APICallMessage()
-        debug(f"Serving API call received on {topic} with content {payload}")
+        data = None
+        debug("Serving API call received on %s with content %s", topic, payload)
         if call_msg.from_json(payload):
-            response = APIResponseMessage(sumo_id, call_msg.api_code, call_msg.transaction_id)
+            handler = self.handlers.get(call_msg.api_code)
             try:
-                if call_msg.api_code == CC_PAR_VEHICLE_DATA:
-                    data = self.plexe.get_vehicle_data(sumo_id)
-                    result = self.__plexe_vehicle_data_to_mqtt(sumo_id, data)
-                    response.set_field("response", result.to_json())
-                if call_msg.api_code == PAR_LEADER_SPEED_AND_ACCELERATION:
-                    msg = VehicleDataMessage()
-                    msg.from_json(call_msg.parameters)
-                    data = self.__mqtt_to_plexe_vehicle_data(msg)
-                    self.plexe.set_leader_vehicle_data(sumo_id, data)
-                    response.set_field("response", "true")
-                if call_msg.api_code == PAR_PRECEDING_SPEED_AND_ACCELERATION:
-                    msg = VehicleDataMessage()
-                    msg.from_json(call_msg.parameters)
-                    data = self.__mqtt_to_plexe_vehicle_data(msg)
-                    self.plexe.set_front_vehicle_data(sumo_id, data)
-                    response.set_field("response", "true")
-                if call_msg.api_code == PAR_CC_DESIRED_SPEED:
-                    msg = VehicleDataMessage()
-                    msg.from_json(call_msg.parameters)
-                    self.plexe.set_cc_desired_speed(sumo_id, msg.speed)
-                    response.set_field("response", "true")
-                if call_msg.api_code == PAR_ACTIVE_CONTROLLER:
-                    controller = int(call_msg.parameters)
-                    self.plexe.set_active_controller(sumo_id, controller)
-                    response.set_field("response", "true")
+                msg = None
+                if call_msg.api_code in VDM_APIS:
+                    # parse the parameters once here, instead of in each handler
+                    msg = self.__parse_vehicle_data(call_msg.parameters)
+                if call_msg.api_code in VDM_APIS and msg is None:
+                    # answer anyhow, with an empty response, so that the caller is not left waiting
+                    error("Invalid parameters for API %s called by vehicle %s: %s", call_msg.api_code, sumo_id,
+                          call_msg.parameters)
+                    result = None
+                else:
+                    result = handler(sumo_id, call_msg, msg) if handler is not None else None
+                # only the fields depending on the call need to be updated before serializing the response
+                content = response["content"]
+                content["api_code"] = call_msg.api_code
+                content["transaction_id"] = call_msg.transaction_id
+                content["response"] = result
+                data = json_dumps(response)
             except FatalTraCIError as e:
-                error(f"TraCI returned exception {e}")
-                response = None
-        if response is not None:
-            debug(f"Returning response {response.to_json()} on topic {topic}")
-        return response_topic, response
+                error("TraCI returned exception %s", e)
+        if data is not None:
+            debug("Returning response %s on topic %s", data, response_topic)
+        return response_topic, data
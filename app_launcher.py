@@ -18,6 +18,8 @@
 from configargparse import ArgumentParser
 from importlib import import_module
 from logging import basicConfig, DEBUG, WARNING
+from os import _exit
+from signal import signal, SIGTERM
 
 
 def main():
@@ -43,6 +45,14 @@ def main():
     addresses = args.addresses
     app = application(sumo_id, broker, port, sumo_id, colosseum_id, parameters, False, addresses)
     app.start_application()
+
+    def terminate(signum, frame):
+        # the application is never stopped on the nodes, the process is killed instead. write the queued log lines
+        # before exiting, as the threads of the application would prevent a normal exit
+        app.flush_log()
+        _exit(128 + signum)
+
+    signal(SIGTERM, terminate)
     app.join_threads()
 
 
@@ -15,19 +15,37 @@
 # along with this program.  If not, see http://www.gnu.org/licenses/.
 #
 from abc import abstractmethod
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 from json import loads
-from logging import error, debug, warning
+from logging import DEBUG, error, debug, getLogger, warning
 from os import _exit
+from queue import Empty, SimpleQueue
 from random import random, seed
-from threading import Lock, Semaphore
+from threading import Event, Lock, local
 import time
 import socket
-import json
 
-from constants import TOPIC_API_CALL, TOPIC_API_RESPONSE, TOPIC_DIRECT_COMM
-from killing_thread import KillingThread
-from messages import APICallMessage, APIResponseMessage, VehicleDataMessage
+from constants import TOPIC_API_CALL, TOPIC_API_RESPONSE, TOPIC_DIRECT_COMM, TOPIC_GROUP_COMM
+from killing_thread import KillingThread, kill_on_exception
+from messages import APICallMessage, APIResponseMessage, VehicleDataMessage, json_loads
 from mqtt_client import MQTTClient
+from udp_batch import BatchReceiver, sendmmsg, UDP_BUFFER_SIZE, UDP_RECEIVE_BATCH, UDP_MAX_DATAGRAM
+
+# number of threads processing the packets received via MQTT in test mode
+RECEIVE_WORKERS = 4
+# maximum time (in seconds) the log writer waits for new lines before checking whether the application is still running
+LOG_WRITER_TIMEOUT = 1
+
+class APICallSlot:
+    """ Used by a thread to wait for the return value of a blocking API call
+    """
+    def __init__(self):
+        self.event = Event()
+        self.return_value = None
+        # transaction the slot is currently waiting for
+        self.transaction_id = None
+
 
 class Application(MQTTClient):
     """ Base class to be used by all applications
@@ -52,28 +70,37 @@ class Application(MQTTClient):
         self.test_mode = test_mode
         self.start_time = -1
         self.disable_loss_rate_after = -1
-        if self.test_mode and "loss_rate" in self.parameters.keys():
+        if self.test_mode and "loss_rate" in self.parameters:
             self.loss_rate = float(self.parameters["loss_rate"])
-            if "seed" in self.parameters.keys():
+            if "seed" in self.parameters:
                 seed(int(self.parameters["seed"]))
             else:
                 seed(0)
-            if "disable_loss_rate_after" in self.parameters.keys():
+            if "disable_loss_rate_after" in self.parameters:
                 self.disable_loss_rate_after = float(self.parameters["disable_loss_rate_after"])
         # MQTT topics used to send/receive data to/from SUMO
         self.topic_api_call = TOPIC_API_CALL.format(sumo_id=sumo_id)
         self.topic_api_response = TOPIC_API_RESPONSE.format(sumo_id=sumo_id)
+        # MQTT topic used to receive data directly from other vehicles in test mode
+        self.topic_direct_comm = TOPIC_DIRECT_COMM.format(sumo_id=sumo_id)
+        # MQTT topics used to send data directly to other vehicles, indexed by destination
+        self.direct_comm_topics = {}
+        # groups this vehicle receives packets for, and the corresponding MQTT topics used in test mode
+        self.groups = set()
+        self.group_topics = set()
         # variables used to have a synchronous API callback
         # used to understand whether the answer is for the request we made
         self.transaction_id = 0
-        # value returned by the api calls
-        self.api_call_return_value = {}
-        # semaphores used to block each API call to wait for the return value
-        self.api_semaphores = {}
+        # slots of the API calls waiting for their return value, indexed by transaction id
+        self.pending_api_calls = {}
+        # each thread reuses the same slot for all its API calls, as it can only wait for one at a time
+        self.api_call_slots = local()
         # mutex used to manage the transaction id
         self.mutex_transaction = Lock()
         # set of running threads
         self.threads = []
+        # threads processing the packets received via MQTT in test mode
+        self.receive_pool = ThreadPoolExecutor(max_workers=RECEIVE_WORKERS)
         self.run = True
         self.parse_parameters()
         self.connect_mqtt()
@@ -83,53 +110,71 @@ class Application(MQTTClient):
             self.udp_port = 10000 #TODO: should we make this a param?
             self.udp_server = None
             self.udp_thread = None
-            self.udp_sockets = {}
+            self.udp_socket = None
+            # (address, port) of all the destinations of broadcast packets
+            self.udp_destinations = [(addr, self.udp_port) for addr in self.addresses]
             self.init_udp()
-        # init logfile
-        self.mutex_logfile = Lock()
-        self.logfile = open(f"logs/{self.sumo_id}.log", "w")
+        # init logfile. lines are queued and written in batches by log_writer_thread()
+        self.log_queue = SimpleQueue()
+        self.logfile = open(f"logs/{self.sumo_id}.log", "wb")
+        # write the queued lines even if the process exits without stopping the application
+        atexit.register(self.flush_log)
     
     def init_udp(self):
         # server socket
         self.udp_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER_SIZE)
         self.udp_server.bind(('0.0.0.0', self.udp_port))
         self.udp_thread = KillingThread(target=self.udp_worker)
         self.udp_thread.start()
         
-        # client sockets #TODO: do we need multiple? probably not since they are statless
-        for a in self.addresses:
-            tx_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.udp_sockets[a] = tx_socket
+        # client socket. UDP is stateless, so a single socket can send to all the destinations
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_BUFFER_SIZE)
 
     def udp_worker(self):
         debug("Started UDP Server")
+        receiver = BatchReceiver(self.udp_server, UDP_RECEIVE_BATCH, UDP_MAX_DATAGRAM)
         while self.run:
-            blob, addr = self.udp_server.recvfrom(2014)
-            data = json.loads(blob)
-            message = VehicleDataMessage()
-            if message.from_json(blob) and data["content"]["recipient"] == self.sumo_id:
-                # process data only if I am the recipient of the packet
-                self.receive(data['content']['sender'], message)
+            for blob in receiver.receive():
+                data = json_loads(blob)
+                # process data only if I am the recipient of the packet or I belong to the recipient group
+                recipient = data["content"].get("recipient")
+                if recipient != self.sumo_id and recipient not in self.groups:
+                    continue
+                message = VehicleDataMessage()
+                if message.from_dict(data):
+                    self.receive(message.sender, message)
 
     def udp_broadcast(self, data):
-        for addr in self.udp_sockets.keys():
-            self.udp_unicast(data, addr)
+        # the same payload is sent to all the addresses with a single system call, and it is encoded only if needed
+        payload = data.encode('utf-8') if isinstance(data, str) else data
+        sendmmsg(self.udp_socket, [(payload, destination) for destination in self.udp_destinations])
     
     def udp_unicast(self, data, addr):
-        payload = data.encode('utf-8')
-        self.udp_sockets[addr].sendto(payload, (addr, self.udp_port))
+        payload = data.encode('utf-8') if isinstance(data, str) else data
+        self.udp_socket.sendto(payload, (addr, self.udp_port))
 
     def parse_parameters(self):
         # should be overridden by subclass
         pass
 
     def on_connect(self):
-        self.subscribe(TOPIC_API_RESPONSE.format(sumo_id=self.sumo_id))
-        self.subscribe(TOPIC_DIRECT_COMM.format(sumo_id=self.sumo_id))
+        self.subscribe(self.topic_api_response)
+        self.subscribe(self.topic_direct_comm)
+        for topic in self.group_topics:
+            self.subscribe(topic)
+
+    def join_group(self, group_id):
+        """ Makes this vehicle receive the packets sent to a group with transmit_group(). Must be called within
+        parse_parameters(), i.e., before connecting to the MQTT broker
+        :param group_id: id of the group, which must not be the sumo id of any vehicle
+        """
+        self.groups.add(group_id)
+        self.group_topics.add(TOPIC_GROUP_COMM.format(group_id=group_id))
 
     def start_thread(self, method, params=()):
-        while not self.client.is_connected():
-            time.sleep(0.1)
+        self.connected_event.wait()
         thread = KillingThread(target=method, args=params)
         self.threads.append(thread)
         thread.start()
@@ -151,6 +196,7 @@ class Application(MQTTClient):
     def start_application(self):
         self.start_time = time.time()
         self.on_start_application()
+        self.start_thread(self.log_writer_thread)
         if self.disable_loss_rate_after > 0:
             self.start_thread(self.disable_loss_rate)
 
@@ -159,37 +205,82 @@ class Application(MQTTClient):
         self.on_stop_application()
         self.join_threads()
         self.client.disconnect()
+        self.receive_pool.shutdown(wait=False, cancel_futures=True)
+        self.flush_log()
+        atexit.unregister(self.flush_log)
     
     def log_packet(self, source, packet):
-        warning(f"Logging received packet {packet.to_json()} from {source} at {time.time()}")
-        with self.mutex_logfile:
-            self.logfile.write(f"RX_MSG;{time.time()};{source};{packet.to_json()}\n")
-            self.logfile.flush()
+        # serialize the packet only once, for both the debug message and the logfile
+        data = packet.to_json()
+        now = time.time()
+        debug("Logging received packet %s from %s at %s", data, source, now)
+        self.__log_line(f"RX_MSG;{now};{source};{data}\n".encode())
     
     def log_position(self, pos):
-        warning(f"Logging current position {pos}")
-        with self.mutex_logfile:
-            self.logfile.write(f"POS;{time.time()};{pos}\n")
-            self.logfile.flush()
+        # logged for every beacon, so only at debug level
+        debug("Logging current position %s", pos)
+        self.__log_line(f"POS;{time.time()};{pos}\n".encode())
     
     def custom_log(self, line):
-        with self.mutex_logfile:
-            self.logfile.write(f"{line}\n")
+        self.__log_line(f"{line}\n".encode())
+
+    def __log_line(self, line):
+        # lines are written by log_writer_thread(), so threads sending and receiving packets never block on the logfile
+        self.log_queue.put(line)
+
+    def flush_log(self, lines=None):
+        """ Writes all the queued lines to the logfile and flushes it
+        :param lines: lines already taken from the queue, to be written before the queued ones
+        """
+        lines = lines if lines is not None else []
+        try:
+            while True:
+                lines.append(self.log_queue.get_nowait())
+        except Empty:
+            pass
+        if lines:
+            self.logfile.write(b"".join(lines))
             self.logfile.flush()
 
+    def log_writer_thread(self):
+        # wait for new lines and write them together with the ones queued in the meantime, so that the logfile never
+        # lags behind
+        while self.run:
+            try:
+                line = self.log_queue.get(timeout=LOG_WRITER_TIMEOUT)
+            except Empty:
+                continue
+            self.flush_log([line])
+
     def transmit(self, destination, packet):
         """ Method used to send a packet through the communication interface
         :param destination: destination node id. TODO: is there something else needed? Is the colosseum_id enough as destination?
-        :param packet: data packet to be sent
+        :param packet: data packet to be sent, either as a string or already encoded as bytes
         """
         if not self.test_mode:
             # TODO: implement this method
-            debug(f"Sending broadcast packet via stack from {self.sumo_id} to {destination}: {packet}")
+            debug("Sending broadcast packet via stack from %s to %s: %s", self.sumo_id, destination, packet)
             self.udp_broadcast(packet)
             pass
         else:
-            warning(f"Sending packet directly from {self.sumo_id} to {destination}: {packet}")
-            self.publish(TOPIC_DIRECT_COMM.format(sumo_id=destination), packet)
+            warning("Sending packet directly from %s to %s: %s", self.sumo_id, destination, packet)
+            topic = self.direct_comm_topics.get(destination)
+            if topic is None:
+                topic = TOPIC_DIRECT_COMM.format(sumo_id=destination)
+                self.direct_comm_topics[destination] = topic
+            self.publish(topic, packet)
+
+    def transmit_group(self, group_id, packet):
+        """ Method used to send a single packet to all the vehicles which joined a group
+        :param group_id: id of the destination group
+        :param packet: data packet to be sent, either as a string or already encoded as bytes
+        """
+        if not self.test_mode:
+            debug("Sending broadcast packet via stack from %s to group %s: %s", self.sumo_id, group_id, packet)
+            self.udp_broadcast(packet)
+        else:
+            warning("Sending packet directly from %s to group %s: %s", self.sumo_id, group_id, packet)
+            self.publish(TOPIC_GROUP_COMM.format(group_id=group_id), packet)
 
     def receive(self, source, packet):
         """ Callback invoked by Colosseum when a packet for this vehicle has been received. This method should be
@@ -200,28 +291,29 @@ class Application(MQTTClient):
         pass
 
     def on_message(self, client, userdata, msg):
-        payload = msg.payload.decode()
-        debug(f"Received {payload} from {msg.topic} topic")
+        # lazy formatting, so that the payload is neither decoded nor formatted when debug logging is disabled
+        debug("Received %s from %s topic", msg.payload, msg.topic)
         if msg.topic == self.topic_api_response:
             message = APIResponseMessage()
-            if message.from_json(payload):
+            if message.from_dict(json_loads(msg.payload)):
                 self.__plexe_api_return(message)
         if self.test_mode:
-            if msg.topic == TOPIC_DIRECT_COMM.format(sumo_id=self.sumo_id):
+            if msg.topic == self.topic_direct_comm or msg.topic in self.group_topics:
                 message = VehicleDataMessage()
-                if message.from_json(payload):
+                if message.from_dict(json_loads(msg.payload)):
                     if self.loss_rate > 0 and random() < self.loss_rate:
-                        debug(f"Vehicle {self.sumo_id} artificially dropping packet from {message.sender}")
+                        debug("Vehicle %s artificially dropping packet from %s", self.sumo_id, message.sender)
                         return
                     # receive must be called in a thread otherwise if we invoke an API (which uses MQTT) and we stop
                     # waiting for the answer, the MQTT client will also be blocked and won't be able to publish the call
-                    receive_thread = KillingThread(target=self.receive, args=(message.sender, message))
-                    receive_thread.start()
+                    if self.run:
+                        future = self.receive_pool.submit(self.receive, message.sender, message)
+                        future.add_done_callback(kill_on_exception)
 
     def disable_loss_rate(self):
         while self.run:
             if self.start_time > 0 and time.time() - self.start_time > self.disable_loss_rate_after:
-                debug(f"Vehicle {self.sumo_id} disabling artificial loss rate")
+                debug("Vehicle %s disabling artificial loss rate", self.sumo_id)
                 self.loss_rate = 0
                 return
             time.sleep(0.1)
@@ -229,7 +321,7 @@ class Application(MQTTClient):
     def call_plexe_api(self, api_code, parameters):
         """ Send via MQTT a Plexe API call. This is basically a blocking RPC call done via MQTT
         :param api_code: API to be called (constants in Plexe.ccparams)
-        :param parameters: list of parameters to be passed as a string
+        :param parameters: parameters to be passed, either as a string or as an object which can be serialized to json
         :return result of the call (depending on the API) or None if the call was not successful (e.g., sumo
         has been terminated)
         """
@@ -239,39 +331,47 @@ class Application(MQTTClient):
         self.transaction_id = self.transaction_id + 1
         self.mutex_transaction.release()
 
+        slot = getattr(self.api_call_slots, "slot", None)
+        if slot is None:
+            slot = APICallSlot()
+            self.api_call_slots.slot = slot
+        slot.event.clear()
+        slot.return_value = None
+        slot.transaction_id = transaction_id
+
         msg = APICallMessage(self.sumo_id, api_code, transaction_id, parameters)
-        self.api_semaphores[transaction_id] = Semaphore(0)
+        self.pending_api_calls[transaction_id] = slot
         data = msg.to_json()
         # send API call
-        debug(f"Sending API call {self.topic_api_call} with content {data}")
+        debug("Sending API call %s with content %s", self.topic_api_call, data)
         self.publish(self.topic_api_call, data)
         # and block waiting for the result
-        debug(f"Blocking caller through semaphore[{transaction_id}]")
-        while not self.api_semaphores[transaction_id].acquire(blocking=True, timeout=1):
+        debug("Blocking caller waiting for transaction %s", transaction_id)
+        while not slot.event.wait(timeout=1):
             # do a blocking call but with a timeout, to enable stopping the thread in case of end of simulation
             if not self.run:
                 return None
-        # when we pass past the lock, the return value will be set and we can return it to the caller
-        return_value = self.api_call_return_value[transaction_id]
-        del self.api_call_return_value[transaction_id]
-        del self.api_semaphores[transaction_id]
-        return return_value
+        # when the event is set, the return value has been copied into the slot
+        return slot.return_value
 
     def __plexe_api_return(self, msg):
-        debug(f"API returned {msg.to_json()}")
+        if getLogger().isEnabledFor(DEBUG):
+            # avoid serializing the response again just to discard the message
+            debug("API returned %s", msg.to_json())
         # this callback result has not been invoked by this vehicle. ignore it
         if msg.sumo_id != self.sumo_id:
             return
-        if msg.transaction_id not in self.api_semaphores.keys():
-            error(f"__plexe_api_return: vehicle {self.sumo_id} got api response for transaction {msg.transaction_id}, "
-                  f"which does not exist")
+        slot = self.pending_api_calls.pop(msg.transaction_id, None)
+        if slot is None:
+            error("__plexe_api_return: vehicle %s got api response for transaction %s, which does not exist",
+                  self.sumo_id, msg.transaction_id)
             _exit(1)
         # copy return value
-        if msg.transaction_id in self.api_call_return_value.keys():
-            # safety check!
-            error(f"Return value for transaction {msg.transaction_id} already set!")
+        if slot.transaction_id != msg.transaction_id or slot.event.is_set():
+            # safety check! the slot has already been reused by a new call or the value has already been returned
+            error("Return value for transaction %s already set!", msg.transaction_id)
             _exit(1)
-        self.api_call_return_value[msg.transaction_id] = msg.response
+        slot.return_value = msg.response
         # unlock caller
-        debug(f"Unlocking caller waiting for semaphore[{msg.transaction_id}]")
-        self.api_semaphores[msg.transaction_id].release()
+        debug("Unlocking caller waiting for transaction %s", msg.transaction_id)
+        slot.event.set()
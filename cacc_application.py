@@ -14,15 +14,19 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see http://www.gnu.org/licenses/.
 #
-from logging import debug, warning
-from time import sleep, time_ns
+from logging import debug, getLogger, DEBUG
+from time import monotonic, sleep, time_ns
 import time
 
 from plexe.plexe_imp.ccparams import PAR_LEADER_SPEED_AND_ACCELERATION, PAR_PRECEDING_SPEED_AND_ACCELERATION, \
     CC_PAR_VEHICLE_DATA, PAR_CC_DESIRED_SPEED, PAR_ACTIVE_CONTROLLER, CACC, ACC
 
 from application import Application
-from messages import VehicleDataMessage
+from messages import VehicleDataMessage, json_dumpb, json_loads
+
+# parameters of the PAR_ACTIVE_CONTROLLER API call, formatted once
+CACC_PARAMETER = str(CACC)
+ACC_PARAMETER = str(ACC)
 
 
 class CACCApplication(Application):
@@ -44,11 +48,19 @@ class CACCApplication(Application):
         self.leader = None
         self.preceding = None
         self.following = None
+        # id of the group including all the vehicles of the platoon, used by the leader to send a single beacon
+        self.platoon_group = None
+        # Plexe APIs to be invoked with the data received from each vehicle, indexed by sumo id
+        self.source_apis = {}
         self.beacon_interval = None
+        # cpu the beaconing thread is pinned to, if any
+        self.pin_cpu = None
         self.min_speed = None
         self.max_speed = None
         self.using_cacc = True
         self.retry_cacc = -1
+        # position of each vehicle within the formation, indexed by sumo id
+        self.formation_index = {}
         # timer indicating when the last packet from a vehicle has been received
         self.last_received_time = {}
         # sequence number of last packet received from number
@@ -58,29 +70,38 @@ class CACCApplication(Application):
         self.run_loss_monitors = True
         self.beacon_id = 0
         super().__init__(client_id, broker, port, sumo_id, colosseum_id, parameters, test_mode, addresses)
+        # envelope reused for all the beacons, only its content changes
+        self.beacon = {"type": VehicleDataMessage.TYPE, "content": None}
 
     def parse_parameters(self):
         """ Parameters expected in self.parameters:
         platoon_formation: formation of the platoon this vehicle is currently in (list of sumo ids)
         beacon_interval: interval between beacons being set (in seconds)
+        pin_cpu: (optional) cpu the beaconing thread should be pinned to, to reduce scheduling jitter
         test_mode: whether the application is running on the real colosseum communication stack or not
         """
-        self.formation = self.parameters["platoon_formation"]
-        self.position = self.formation.index(self.sumo_id)
+        self.formation = tuple(self.parameters["platoon_formation"])
+        self.formation_index = {vehicle: i for i, vehicle in enumerate(self.formation)}
+        self.position = self.formation_index[self.sumo_id]
         self.is_leader = self.position == 0
         self.is_last = self.position == len(self.formation) - 1
+        # neighbors are resolved once here, the leader has no leader or preceding vehicle and the last vehicle has no
+        # following vehicle
+        self.leader = self.formation[0] if not self.is_leader else None
+        self.preceding = self.formation[self.position - 1] if not self.is_leader else None
+        self.following = self.formation[self.position + 1] if not self.is_last else None
+        self.platoon_group = f"platoon_{self.formation[0]}"
         if not self.is_leader:
-            self.leader = self.formation[0]
-            self.preceding = self.formation[self.position-1]
-            if not self.is_last:
-                self.following = self.formation[self.position+1]
-            else:
-                self.following = None
-        else:
-            self.leader = None
-            self.preceding = None
-            self.following = self.formation[self.position+1]
+            self.join_group(self.platoon_group)
+        # the leader uses no other vehicle data. for the first follower, leader and preceding are the same vehicle
+        self.source_apis = {}
+        if self.leader is not None:
+            self.source_apis[self.leader] = (PAR_LEADER_SPEED_AND_ACCELERATION,)
+            self.source_apis[self.preceding] = self.source_apis.get(self.preceding, ()) + \
+                (PAR_PRECEDING_SPEED_AND_ACCELERATION,)
         self.beacon_interval = float(self.parameters["beacon_interval"])
+        if "pin_cpu" in self.parameters:
+            self.pin_cpu = int(self.parameters["pin_cpu"])
         self.min_speed = float(self.parameters["min_speed"])
         self.max_speed = float(self.parameters["max_speed"])
 
@@ -93,17 +114,20 @@ class CACCApplication(Application):
 
     def update_packets_stats(self, source, packet):
 
-        delay = time.time() - packet.ts
+        # beacon timestamps are set by other hosts, so the delay must be computed with the wall clock
+        now = time.time()
+        delay = now - packet.ts
         if delay > 0.3:
             if self.using_cacc:
                 # fallback to ACC
                 self.loss_detected()
-            self.retry_cacc = time.time() + 5
+            self.retry_cacc = now + 5
 
-        if time.time() > self.retry_cacc:
+        # only switch back when ACC is actually in use, instead of calling the API again for every packet
+        if now > self.retry_cacc and not self.using_cacc:
             self.using_cacc = True
-            self.call_plexe_api(PAR_ACTIVE_CONTROLLER, str(CACC))
-            debug(f"Vehicle {self.sumo_id} reactivating CACC")
+            self.call_plexe_api(PAR_ACTIVE_CONTROLLER, CACC_PARAMETER)
+            debug("Vehicle %s reactivating CACC", self.sumo_id)
 
         # self.last_received_time[source] = time_ns() / 1e9
         # if source not in self.last_received_seqn:
@@ -119,72 +143,87 @@ class CACCApplication(Application):
         #     # check stats to see if we can switch back to CACC
         #     if self.consecutive_packets[self.leader] >= 5 and self.consecutive_packets[self.preceding] >= 5:
         #         self.using_cacc = True
-        #         self.call_plexe_api(PAR_ACTIVE_CONTROLLER, str(CACC))
+        #         self.call_plexe_api(PAR_ACTIVE_CONTROLLER, CACC_PARAMETER)
         #         self.start_packet_loss_monitors()
         #         debug(f"Vehicle {self.sumo_id} reactivating CACC")
         #         # TODO: log change of controller
 
     def receive(self, source, packet):
-        # leader uses no other vehicle data
         self.log_packet(source, packet)
-        if self.is_leader:
+        # a single lookup tells whether the data of the sender is used (never for the leader) and by which APIs
+        apis = self.source_apis.get(source)
+        if apis is None:
             return
-        if source == self.leader or source == self.preceding:
-            warning(f"{self.sumo_id} received packet from {source}: {packet.to_json()}")
-            self.update_packets_stats(source, packet)
-            if source == self.leader:
-                self.call_plexe_api(PAR_LEADER_SPEED_AND_ACCELERATION, packet.to_json())
-            if source == self.preceding:
-                self.call_plexe_api(PAR_PRECEDING_SPEED_AND_ACCELERATION, packet.to_json())
+        if getLogger().isEnabledFor(DEBUG):
+            # avoid serializing the packet again just to discard the message
+            debug("%s received packet from %s: %s", self.sumo_id, source, packet.to_json())
+        self.update_packets_stats(source, packet)
+        # the packet is passed as an object, so it is serialized only as part of the API call
+        data = packet.to_object()
+        for api in apis:
+            self.call_plexe_api(api, data)
 
     def send_beacon(self):
         data = self.call_plexe_api(CC_PAR_VEHICLE_DATA, self.sumo_id)
         if data is None:
             return
+        # vehicle data is returned as a json string. Parse it once and directly update its content to be used as
+        # beacon, instead of going through a VehicleDataMessage. Already parsed data is accepted as well
+        if isinstance(data, (str, bytes)):
+            data = json_loads(data)
+        content = data["content"]
         #log current location even if I am the last
-        msg = VehicleDataMessage(seqn=self.beacon_id)
-        msg.from_json(data)
-        self.log_position({'x': msg.x, 'y': msg.y})
+        self.log_position({'x': content["x"], 'y': content["y"]})
         
         #TODO: fix questa porcata
         if self.is_last:
             return
     
-        msg.set_field("sender", self.sumo_id)
-        
-        msg.set_field("seqn", self.beacon_id)
+        content["sender"] = self.sumo_id
+        content["seqn"] = self.beacon_id
+        content["ts"] = time.time()
+        beacon = self.beacon
+        beacon["content"] = content
 
         if self.is_leader:
-            for i in range(1, len(self.formation)):
-                msg.set_field("recipient", self.formation[i])
-                msg.set_field("ts", time.time())
-                data = msg.to_json()
-                self.transmit(self.formation[i], data)
+            # a single beacon reaches all the followers
+            content["recipient"] = self.platoon_group
+            self.transmit_group(self.platoon_group, json_dumpb(beacon))
         else:
-            msg.set_field("recipient", self.following)
-            msg.set_field("ts", time.time())
-            data = msg.to_json()
-            self.transmit(self.following, data)
+            content["recipient"] = self.following
+            self.transmit(self.following, json_dumpb(beacon))
         self.beacon_id += 1
 
     def change_speed_thread(self):
-        msg = VehicleDataMessage()
+        # the parameters of the two calls never change, so build them only once
+        accelerate = VehicleDataMessage(speed=25).to_object()
+        brake = VehicleDataMessage(speed=15).to_object()
         while self.run:
             # accelerate first
-            msg.set_field("speed", 25)
-            self.call_plexe_api(PAR_CC_DESIRED_SPEED, msg.to_json())
+            self.call_plexe_api(PAR_CC_DESIRED_SPEED, accelerate)
             # TODO: these two sleeps might block the closure of the simulation for 20 seconds if we are unlucky
             sleep(10)
             # then brake
-            msg.set_field("speed", 15)
-            self.call_plexe_api(PAR_CC_DESIRED_SPEED, msg.to_json())
+            self.call_plexe_api(PAR_CC_DESIRED_SPEED, brake)
             sleep(10)
             # then repeat
 
     def beaconing_thread(self):
+        if self.pin_cpu is not None:
+            # imported here, as it is only available on Linux, where pid 0 refers to the calling thread only
+            from os import sched_setaffinity
+            sched_setaffinity(0, {self.pin_cpu})
+        # schedule beacons on absolute deadlines, so that the time taken by send_beacon() does not accumulate as drift
+        next_beacon = monotonic()
         while self.run:
             self.send_beacon()
-            sleep(self.beacon_interval)
+            next_beacon += self.beacon_interval
+            delay = next_beacon - monotonic()
+            if delay > 0:
+                sleep(delay)
+            else:
+                # too late already, do not try to catch up by sending a burst of beacons
+                next_beacon = monotonic()
 
     def start_packet_loss_monitors(self):
         self.run_loss_monitors = True
@@ -195,19 +234,19 @@ class CACCApplication(Application):
 
     def loss_detected(self):
         # switch to ACC
-        self.call_plexe_api(PAR_ACTIVE_CONTROLLER, str(ACC))
+        self.call_plexe_api(PAR_ACTIVE_CONTROLLER, ACC_PARAMETER)
         self.using_cacc = False
         self.run_loss_monitors = False
-        debug(f"Vehicle {self.sumo_id} falling back to ACC due to packet losses")
+        debug("Vehicle %s falling back to ACC due to packet losses", self.sumo_id)
         # TODO: log fallback event
 
     def loss_monitor(self, vehicle):
         while self.run and self.run_loss_monitors:
             current_time = time_ns() / 1e9
-            if vehicle in self.last_received_time.keys():
+            if vehicle in self.last_received_time:
                 if current_time - self.last_received_time[vehicle] > 0.5:
                     # detect 0.5 seconds silence
-                    debug(f"Vehicle {self.sumo_id} detected no packets from {vehicle} for more than 0.5 seconds")
+                    debug("Vehicle %s detected no packets from %s for more than 0.5 seconds", self.sumo_id, vehicle)
                     self.loss_detected()
                     return
             sleep(self.beacon_interval)
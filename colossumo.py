@@ -23,27 +23,27 @@ import time
 
 from argparse import ArgumentParser
 from importlib import import_module
-from json import loads
-from logging import error, debug, DEBUG, basicConfig
+from logging import error, debug, DEBUG, basicConfig, getLogger
 from os.path import split, join
-from threading import Thread
-from time import sleep
+from threading import Event, Thread
+from time import monotonic, sleep
+from xml.etree.ElementTree import iterparse, parse
+from pyproj import Transformer
 from pyproj.crs.crs import CRS
 
-from libxml2 import parseFile
 import paho.mqtt.client as mqtt
 from plexe import Plexe, RADAR_DISTANCE
 from traci import TraCIException, FatalTraCIError
-from traci.constants import TRACI_ID_LIST, VAR_POSITION
+from traci.constants import VAR_ACCEL, VAR_ARRIVED_VEHICLES_IDS, VAR_DEPARTED_VEHICLES_IDS, VAR_POSITION, \
+    VAR_SPEED, VAR_TIME
 
 from api_interpreter import APIInterpreter
 from application import Application
-from bidict import Bidict
-from constants import COLOSSEUM_UPDATE_TOPIC, SUMO_UPDATE_TOPIC, TOPIC_API_CALL, TOPIC_API_PREFIX
+from constants import COLOSSEUM_UPDATE_TOPIC, SUMO_UPDATE_TOPIC, TOPIC_API_CALL
 from killing_thread import KillingThread
-from messages import MQTTUpdate, DeleteVehicleMessage, NewVehicleMessage, PositionUpdateMessage, CurrentTimeMessage, \
-    StartSimulationMessage, StopSimulationMessage
-from mqtt_client import MQTTClient
+from messages import MQTTUpdate, DeleteVehicleMessage, NewVehicleMessage, StartSimulationMessage, \
+    StopSimulationMessage, json_loads
+from mqtt_client import MQTTClient, MQTT_QOS, configure_socket
 from utils import start_sumo
 
 if 'SUMO_HOME' in os.environ:
@@ -53,9 +53,15 @@ else:
     sys.exit("please declare environment variable 'SUMO_HOME'")
 import traci
 
+# vehicle variables retrieved at each step through the subscription
+VEHICLE_VARIABLES = [VAR_POSITION, VAR_SPEED, VAR_ACCEL]
+# movement (in meters, along each axis) below which the position of a vehicle is not sent again to colosseum
+POSITION_TOLERANCE = 1e-3
+
 
 class Colossumo(MQTTClient):
-    def __init__(self, client_id, broker, port, config, scenario, application, parameters, available_nodes, gui, test):
+    def __init__(self, client_id, broker, port, config, scenario, application, parameters, available_nodes, gui, test,
+                 batch_steps=1):
         """ Constructor
         :param client_id: client id to be used for MQTT broker
         :param broker: IP of MQTT broker
@@ -69,10 +75,13 @@ class Colossumo(MQTTClient):
         :param available_nodes: list of nodes available in colosseum. TODO: automatically retrieve this list in future
         :param gui: use SUMO in GUI mode or not
         :param test: Boolean: in test mode, Colosseum is not used and communication is handled by Colossumo
+        :param batch_steps: number of simulation steps covered by a single update to colosseum. Updates are anyhow sent
+        immediately when vehicles enter or leave the simulation
         """
         super().__init__(client_id, broker, port)
         self.plexe = None
-        self.listeners = []
+        # tuple of the functions notified of every MQTT message, usually empty
+        self.listeners = ()
         self.config = config
         self.scenario = scenario
         self.application = application
@@ -82,8 +91,12 @@ class Colossumo(MQTTClient):
         self.sumo_vehicles = set()
         # list of available node ids in colosseum
         self.available_nodes = set(available_nodes)
-        # map from sumo vehicle id to colosseum node id
-        self.vehicle_to_node = Bidict()
+        # map from sumo vehicle id to colosseum node id, and its inverse
+        self.vehicle_to_node = {}
+        self.node_to_vehicle = {}
+        # last (x, y) sumo position sent to colosseum for each vehicle
+        self.last_positions = {}
+        self.batch_steps = batch_steps
         # use SUMO GUI/CLI mode
         self.gui = gui
         # enable/disable test mode (w/o or w/ colosseun)
@@ -94,10 +107,20 @@ class Colossumo(MQTTClient):
         self.use_geo_coord = False
         # CRS code for coordinate projection
         self.crs = None
-        # waiting colosseum signal to start the simulation
-        self.waiting_for_colosseum = False
-        # signal from colosseum to stop simulation
-        self.stop_simulation = False
+        # offset between SUMO network coordinates and projected coordinates
+        self.net_offset = (0.0, 0.0)
+        # transformer from projected coordinates to longitude and latitude, None if the network has no projection
+        self.geo_transformer = None
+        # cleared while waiting colosseum signal to start the simulation
+        self.start_event = Event()
+        self.start_event.set()
+        # set when the simulation must be stopped (e.g., signal from colosseum)
+        self.stop_event = Event()
+        # actions triggered by the commands received from colosseum, indexed by message type
+        self.colosseum_commands = {
+            StartSimulationMessage.TYPE: self.start_event.set,
+            StopSimulationMessage.TYPE: self.stop_event.set,
+        }
         # API interpreter utility
         self.api_interpreter = None
         #log files for position
@@ -107,6 +130,7 @@ class Colossumo(MQTTClient):
         if rc == 0:
             self.connected = True
             debug("Connected to MQTT Broker!")
+            self.connected_event.set()
         else:
             error("Failed to connect, return code %d\n", rc)
 
@@ -114,6 +138,11 @@ class Colossumo(MQTTClient):
         client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, self.client_id)
         client.username_pw_set("user", "pwd")
         client.on_connect = self.on_connect
+        client.on_socket_open = configure_socket
+        client.on_message = self.on_message
+        # paho hands messages directly to the callback registered for their topic, on_message only gets the others
+        client.message_callback_add(COLOSSEUM_UPDATE_TOPIC, self.on_colosseum_update)
+        client.message_callback_add(TOPIC_API_CALL.format(sumo_id="+"), self.on_api_call)
         client.connect(self.broker, self.port)
         client.loop_start()
         self.client = client
@@ -124,30 +153,44 @@ class Colossumo(MQTTClient):
             self.client.disconnect()
 
     def publish(self, topic, data):
-        result = self.client.publish(topic, data)
+        result = self.client.publish(topic, data, qos=MQTT_QOS, retain=False)
         # result: [0, 1]
         status = result[0]
         return status == 0
 
     def on_message(self, client, userdata, msg):
+        # lazy formatting, so that messages are not formatted when debug logging is disabled
+        debug("Received %s from %s topic", msg.payload, msg.topic)
+        listeners = self.listeners
+        if listeners:
+            for listener in listeners:
+                listener(msg)
+
+    def on_colosseum_update(self, client, userdata, msg):
+        debug("Received %s from %s topic", msg.payload, msg.topic)
+        listeners = self.listeners
+        if listeners:
+            for listener in listeners:
+                listener(msg)
+        # the payload is parsed straight from the raw bytes, without decoding it first
+        command = self.colosseum_commands.get(json_loads(msg.payload).get("type"))
+        if command is not None:
+            command()
+
+    def on_api_call(self, client, userdata, msg):
         payload = msg.payload.decode()
-        debug("Received {} from {} topic".format(payload, msg.topic))
-        for listener in self.listeners:
-            listener(msg)
-        if msg.topic == COLOSSEUM_UPDATE_TOPIC:
-            m = loads(payload)
-            if "type" in m.keys():
-                if m["type"] == StartSimulationMessage.TYPE:
-                    self.waiting_for_colosseum = False
-                if m["type"] == StopSimulationMessage.TYPE:
-                    self.stop_simulation = True
-        if msg.topic.startswith(TOPIC_API_PREFIX):
-            response_topic, result = self.api_interpreter.serve_api_call(msg.topic, payload)
-            if result is not None:
-                self.publish(response_topic, result.to_json())
+        debug("Received %s from %s topic", payload, msg.topic)
+        listeners = self.listeners
+        if listeners:
+            for listener in listeners:
+                listener(msg)
+        response_topic, response = self.api_interpreter.serve_api_call(msg.topic, payload)
+        if response is not None:
+            self.publish(response_topic, response)
 
     def add_listener(self, listener):
-        self.listeners.append(listener)
+        # listeners are rarely added, so the tuple is simply rebuilt
+        self.listeners = self.listeners + (listener,)
 
     def assign_free_colosseum_node(self, sumo_vehicle):
         if len(self.available_nodes) == 0:
@@ -155,50 +198,49 @@ class Colossumo(MQTTClient):
         else:
             colosseum_node = self.available_nodes.pop()
             self.vehicle_to_node[sumo_vehicle] = colosseum_node
+            self.node_to_vehicle[colosseum_node] = sumo_vehicle
             return colosseum_node
 
     def release_colosseum_node(self, sumo_vehicle):
-        if sumo_vehicle not in self.vehicle_to_node.keys():
-            return -1
-        else:
-            colosseum_node = self.vehicle_to_node[sumo_vehicle]
+        colosseum_node = self.vehicle_to_node.pop(sumo_vehicle, -1)
+        if colosseum_node != -1:
+            del self.node_to_vehicle[colosseum_node]
+            self.last_positions.pop(sumo_vehicle, None)
             self.available_nodes.add(colosseum_node)
-            return colosseum_node
+        return colosseum_node
 
     def get_colosseum_node(self, sumo_vehicle_id):
-        if sumo_vehicle_id not in self.vehicle_to_node.keys():
-            return -1
-        else:
-            return self.vehicle_to_node[sumo_vehicle_id]
+        return self.vehicle_to_node.get(sumo_vehicle_id, -1)
 
     def get_sumo_vehicle(self, colosseum_node_id):
-        inv_map = self.vehicle_to_node.inverse()
-        if colosseum_node_id not in inv_map.keys():
-            return ""
-        else:
-            return inv_map[colosseum_node_id]
+        return self.node_to_vehicle.get(colosseum_node_id, "")
 
     def load_sumo_config(self):
         """ Retrieve sumo configuration data such as the coordinate reference system and the simulation timestep
         """
-        sumo_cfg_doc = parseFile(self.config)
-        context = sumo_cfg_doc.xpathNewContext()
+        configuration = parse(self.config).getroot()
         # get simulation timestep
-        self.timestep = float(context.xpathEval("string(//configuration/time/step-length/@value)"))
+        self.timestep = float(configuration.find("time/step-length").get("value"))
         # get sumo net file
-        net_file = context.xpathEval("string(//configuration/input/net-file/@value)")
-        if net_file == "":
+        net_file = configuration.find("input/net-file")
+        if net_file is None or net_file.get("value", "") == "":
             return False
         config_folder, _ = split(self.config)
-        sumo_net_doc = parseFile(join(config_folder, net_file))
-        context = sumo_net_doc.xpathNewContext()
+        # net files can be huge, but the location element comes first: stream the file and stop as soon as it is found
+        coordinate_system = ""
+        for _, element in iterparse(join(config_folder, net_file.get("value")), events=("start",)):
+            if element.tag == "location":
+                coordinate_system = element.get("projParameter", "")
+                offset_x, offset_y = element.get("netOffset", "0,0").split(",")
+                self.net_offset = (float(offset_x), float(offset_y))
+                break
         # get coordinate system if present
-        coordinate_system = context.xpathEval("string(//net/location/@projParameter)")
         if coordinate_system == "" or coordinate_system == "!":
             return False
         # load coordinate reference system
         crs = CRS.from_string(coordinate_system)
         self.crs = ":".join(crs.to_authority())
+        self.geo_transformer = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
         self.use_geo_coord = False
         return True
 
@@ -210,7 +252,7 @@ class Colossumo(MQTTClient):
             # Basically if a new vehicle is created, we are at the beginning, so we tell colosseum about them
             # and then wait for colosseum for the start signal
             if not self.test_mode:
-                self.waiting_for_colosseum = True
+                self.start_event.clear()
             colosseum_node = self.assign_free_colosseum_node(sumo_vehicle)
             if colosseum_node == -1:
                 error("Error: no available free node in colosseum for SUMO vehicle (id={}) ".format(sumo_vehicle))
@@ -220,11 +262,8 @@ class Colossumo(MQTTClient):
                 m = NewVehicleMessage(sumo_vehicle, colosseum_node, application, parameters)
                 update_msg.add(m)
 
-                # get info about vehicle at each time step
-                traci.vehicle.subscribe(sumo_vehicle, [VAR_POSITION])
-
-                # subscribe to MQTT topic to receive API calls from the vehicle
-                self.subscribe(TOPIC_API_CALL.format(sumo_id=sumo_vehicle))
+                # get info about vehicle at each time step, including what log_positions() needs
+                traci.vehicle.subscribe(sumo_vehicle, VEHICLE_VARIABLES)
 
                 if self.test_mode:
                     app = self.application(sumo_vehicle, self.broker, self.port, sumo_vehicle, colosseum_node,
@@ -232,8 +271,8 @@ class Colossumo(MQTTClient):
                     self.applications[sumo_vehicle] = app
                     # don't start the application, we might need to wait for colosseum to give us green light
                     self.applications_to_start.append(app)
-                debug("Adding new SUMO vehicle {} to simulation and assigning it to colosseum node {}"
-                      .format(sumo_vehicle, colosseum_node))
+                debug("Adding new SUMO vehicle %s to simulation and assigning it to colosseum node %s", sumo_vehicle,
+                      colosseum_node)
 
     def process_old_vehicles(self, old_vehicles, update_msg):
         # tell colosseum about all vehicles to be removed, releasing testbed nodes
@@ -254,30 +293,39 @@ class Colossumo(MQTTClient):
                     app = self.applications[sumo_vehicle]
                     app.stop_application()
                     del self.applications[sumo_vehicle]
-                debug("Removing SUMO vehicle {} from simulation and releasing colosseum node {}"
-                      .format(sumo_vehicle, colosseum_node))
+                debug("Removing SUMO vehicle %s from simulation and releasing colosseum node %s", sumo_vehicle,
+                      colosseum_node)
 
     def process_subscriptions(self, subscriptions, update_msg):
-        for sumo_vehicle in self.vehicle_to_node.keys():
-            if sumo_vehicle not in subscriptions.keys():
+        # a single pass over the mapping gives both the vehicle and its node, without further lookups
+        positions = []
+        last_positions = self.last_positions
+        for sumo_vehicle, colosseum_node in self.vehicle_to_node.items():
+            results = subscriptions.get(sumo_vehicle)
+            if results is None:
                 error("Vehicle {} not in subscription results".format(sumo_vehicle))
-            else:
-                colosseum_node = self.get_colosseum_node(sumo_vehicle)
-                if colosseum_node == -1:
-                    error("SUMO vehicle {} is not associated to any node in colosseum".format(sumo_vehicle))
-                else:
-                    x, y = subscriptions[sumo_vehicle][VAR_POSITION]
-                    if self.use_geo_coord:
-                        x_geo, y_geo = traci.simulation.convertGeo(x, y)
-                        m = PositionUpdateMessage(colosseum_node, x_geo, y_geo, self.crs)
-                        debug("SUMO vehicle {} geo coordinates: x={}, y={} ({})"
-                              .format(sumo_vehicle, x_geo, y_geo, self.crs))
-                    else:
-                        m = PositionUpdateMessage(colosseum_node, x, y)
-
-                    update_msg.add(m)
-                    debug("Updating SUMO vehicle {} (colosseum node {}) position (x={}, y={})"
-                          .format(sumo_vehicle, colosseum_node, x, y, self.crs))
+                continue
+            position = results[VAR_POSITION]
+            last_position = last_positions.get(sumo_vehicle)
+            # vehicles which did not move (e.g., queued at a traffic light) do not need to be updated
+            if last_position is not None and abs(position[0] - last_position[0]) <= POSITION_TOLERANCE and \
+                    abs(position[1] - last_position[1]) <= POSITION_TOLERANCE:
+                continue
+            last_positions[sumo_vehicle] = position
+            positions.append((sumo_vehicle, colosseum_node, position))
+        if self.use_geo_coord:
+            # convert all the positions with a single call
+            xs_geo, ys_geo = self.convert_geo([x for _, _, (x, _) in positions], [y for _, _, (_, y) in positions])
+            for (sumo_vehicle, colosseum_node, (x, y)), x_geo, y_geo in zip(positions, xs_geo, ys_geo):
+                update_msg.add_position(colosseum_node, x_geo, y_geo, self.crs)
+                debug("SUMO vehicle %s geo coordinates: x=%s, y=%s (%s)", sumo_vehicle, x_geo, y_geo, self.crs)
+                debug("Updating SUMO vehicle %s (colosseum node %s) position (x=%s, y=%s)", sumo_vehicle,
+                      colosseum_node, x, y)
+        else:
+            for sumo_vehicle, colosseum_node, (x, y) in positions:
+                update_msg.add_position(colosseum_node, x, y)
+                debug("Updating SUMO vehicle %s (colosseum node %s) position (x=%s, y=%s)", sumo_vehicle,
+                      colosseum_node, x, y)
 
     def run_simulation(self, max_time):
         self.load_sumo_config()
@@ -290,56 +338,82 @@ class Colossumo(MQTTClient):
         self.api_interpreter = APIInterpreter(traci, plexe)
         step = 0
         current_time = 0
+        # the same update message is reused at each step
+        update_msg = MQTTUpdate()
         scenario = self.scenario(traci, plexe, self.gui, self.sim_parameters)
-        traci.vehicle.subscribe("", [TRACI_ID_LIST])
-        while current_time <= max_time and not self.stop_simulation:
-
-            while self.waiting_for_colosseum:
+        # only vehicles entering or leaving the simulation are needed to keep track of the existing ones
+        traci.simulation.subscribe([VAR_TIME, VAR_DEPARTED_VEHICLES_IDS, VAR_ARRIVED_VEHICLES_IDS])
+        # deadline of the next step when running in real time
+        next_step = monotonic()
+        # simulation steps not yet notified to colosseum
+        pending_steps = 0
+        while current_time <= max_time and not self.stop_event.is_set():
+
+            # the event wakes the simulation up as soon as the signal arrives, the timeout is only used for logging
+            while not self.start_event.wait(timeout=1) and not self.stop_event.is_set():
                 debug("List of vehicles sent to Colosseum. Waiting signal to start simulation...")
-                sleep(1)
 
             for app in self.applications_to_start:
-                debug(f"Starting application for vehicle {app.sumo_id}")
+                debug("Starting application for vehicle %s", app.sumo_id)
                 app.start_application()
             self.applications_to_start = []
 
-            update_msg = MQTTUpdate()
             try:
                 traci.simulationStep()
             except FatalTraCIError:
                 debug("Caught TraCI exception. Closing simulation")
-                self.stop_simulation = True
+                self.stop_event.set()
                 continue
 
             scenario.step(step)
-            debug("Running simulation step number {}".format(step))
-
-            # inform colosseum about current simulation time
-            current_time = traci.simulation.getTime()
-            update_msg.add(CurrentTimeMessage(current_time))
-            debug("Current simulation time: {}".format(current_time))
+            debug("Running simulation step number %d", step)
 
             # get all updated data
             subscriptions = traci.vehicle.getAllSubscriptionResults()
+            simulation = traci.simulation.getSubscriptionResults()
 
-            # check for new vehicles or deleted ones
-            new_vehicles, old_vehicles = self.update_vehicles(subscriptions[''][TRACI_ID_LIST])
-
-            self.process_old_vehicles(old_vehicles, update_msg)
-            self.process_new_vehicles(new_vehicles, update_msg)
-            self.process_subscriptions(subscriptions, update_msg)
+            # the time comes with the simulation subscription, without a getTime() round trip
+            current_time = simulation[VAR_TIME]
+            debug("Current simulation time: %s", current_time)
 
-            self.publish(SUMO_UPDATE_TOPIC, update_msg.to_json())
-            debug("Publishing update to topic {}:\n{}".format(SUMO_UPDATE_TOPIC, update_msg.to_json()))
+            # check for new vehicles or deleted ones
+            new_vehicles, old_vehicles = self.update_vehicles(simulation[VAR_DEPARTED_VEHICLES_IDS],
+                                                              simulation[VAR_ARRIVED_VEHICLES_IDS])
+
+            pending_steps += 1
+            # only the latest positions matter, so the update is built when it is sent. vehicles entering or leaving the
+            # simulation are always notified immediately
+            if pending_steps >= self.batch_steps or new_vehicles or old_vehicles:
+                pending_steps = 0
+                update_msg.clear()
+                # inform colosseum about current simulation time
+                update_msg.add_time(current_time)
+                self.process_old_vehicles(old_vehicles, update_msg)
+                self.process_new_vehicles(new_vehicles, update_msg)
+                self.process_subscriptions(subscriptions, update_msg)
+
+                # serialize the update only once, for both publishing and logging
+                payload = update_msg.to_json()
+                self.publish(SUMO_UPDATE_TOPIC, payload)
+                if getLogger().isEnabledFor(DEBUG):
+                    # the payload is serialized to bytes, decode it only to log it as text
+                    debug("Publishing update to topic %s:\n%s", SUMO_UPDATE_TOPIC, payload.decode())
             self.log_positions(subscriptions, time.time())
             step += 1
             if not self.gui:
-                # TODO: here we assume that sumo processing time is 0. needs to be updated in the future
-                sleep(self.timestep)
+                # only sleep for what remains of the timestep, so that the time taken by the step does not accumulate
+                next_step += self.timestep
+                delay = next_step - monotonic()
+                if delay > 0:
+                    sleep(delay)
+                else:
+                    # the step took longer than the timestep: do not try to catch up by running steps back to back
+                    next_step = monotonic()
 
         # exited from main simulation loop because it is terminated. cleanup stuff
-        update_msg = MQTTUpdate()
-        for sumo_vehicle in self.vehicle_to_node.keys():
+        update_msg.clear()
+        # releasing nodes removes vehicles from the map, so iterate over a copy
+        for sumo_vehicle in list(self.vehicle_to_node):
             colosseum_node = self.get_colosseum_node(sumo_vehicle)
             if colosseum_node == -1:
                 error("Error: vehicle from SUMO (id={}) not currently registered".format(sumo_vehicle))
@@ -347,10 +421,12 @@ class Colossumo(MQTTClient):
                 self.release_colosseum_node(sumo_vehicle)
                 m = DeleteVehicleMessage(sumo_vehicle, colosseum_node)
                 update_msg.add(m)
-                debug("Removing SUMO vehicle {} from simulation and releasing colosseum node {}"
-                      .format(sumo_vehicle, colosseum_node))
-        self.publish(SUMO_UPDATE_TOPIC, update_msg.to_json())
-        debug("Publishing update to topic {}:\n{}".format(SUMO_UPDATE_TOPIC, update_msg.to_json()))
+                debug("Removing SUMO vehicle %s from simulation and releasing colosseum node %s", sumo_vehicle,
+                      colosseum_node)
+        payload = update_msg.to_json()
+        self.publish(SUMO_UPDATE_TOPIC, payload)
+        if getLogger().isEnabledFor(DEBUG):
+            debug("Publishing update to topic %s:\n%s", SUMO_UPDATE_TOPIC, payload.decode())
 
         if self.test_mode:
             # if we are in test mode, colossumo instantiated application classes itself
@@ -367,25 +443,51 @@ class Colossumo(MQTTClient):
             # if we come here because sumo has been closed, we cannot close it again
             pass
 
-    def update_vehicles(self, sumo_vehicles):
-        new_vehicles = set(sumo_vehicles).difference(self.sumo_vehicles)
-        old_vehicles = self.sumo_vehicles.difference(set(sumo_vehicles))
-        self.sumo_vehicles = set(sumo_vehicles)
+    def update_vehicles(self, departed, arrived):
+        """ Updates the set of vehicles in the simulation, only looking at the changes of the last step
+        :param departed: ids of the vehicles which entered the simulation in the last step
+        :param arrived: ids of the vehicles which left the simulation in the last step
+        :return: tuple with the set of new vehicles and the set of removed vehicles
+        """
+        arrived = set(arrived)
+        # a vehicle might enter and leave within the same step, in which case it is neither new nor old
+        new_vehicles = set(departed).difference(arrived)
+        old_vehicles = arrived.intersection(self.sumo_vehicles)
+        self.sumo_vehicles.update(new_vehicles)
+        self.sumo_vehicles.difference_update(old_vehicles)
         return new_vehicles, old_vehicles
 
+    def convert_geo(self, xs, ys):
+        """ Converts SUMO network coordinates into longitude and latitude, like traci.simulation.convertGeo() but
+        locally and for many positions at once, avoiding a TraCI round trip for each of them
+        :param xs: list of x coordinates
+        :param ys: list of y coordinates
+        :return: tuple with the list of longitudes and the list of latitudes. If the network has no projection, the
+        coordinates are only shifted by the network offset, as SUMO does
+        """
+        offset_x, offset_y = self.net_offset
+        xs = [x - offset_x for x in xs]
+        ys = [y - offset_y for y in ys]
+        if self.geo_transformer is None:
+            return xs, ys
+        return self.geo_transformer.transform(xs, ys)
+
     def log_positions(self, subscriptions, current_time):
-        for sumo_vehicle in self.vehicle_to_node.keys():
-            if sumo_vehicle in subscriptions.keys():
-                x, y = subscriptions[sumo_vehicle][VAR_POSITION]
-                x_geo, y_geo = traci.simulation.convertGeo(x, y)
-                radar_data = self.plexe.get_radar_data(sumo_vehicle)
-                v = traci.vehicle.getSpeed(sumo_vehicle)
-                a = traci.vehicle.getAccel(sumo_vehicle)
-                # log velocita distanza radar e accelerazione
-                self.log_file.write(f"POS;{current_time};{sumo_vehicle};{x};{y};{x_geo};{y_geo}\n")
-                self.log_file.write(f"SPD;{current_time};{sumo_vehicle};{v};{a}\n")
-                self.log_file.write(f"DST;{current_time};{sumo_vehicle};{radar_data[RADAR_DISTANCE]}\n")
-                self.log_file.flush()
+        vehicles = [sumo_vehicle for sumo_vehicle in self.vehicle_to_node if sumo_vehicle in subscriptions]
+        positions = [subscriptions[sumo_vehicle][VAR_POSITION] for sumo_vehicle in vehicles]
+        # convert all the positions with a single call
+        xs_geo, ys_geo = self.convert_geo([x for x, _ in positions], [y for _, y in positions])
+        for sumo_vehicle, (x, y), x_geo, y_geo in zip(vehicles, positions, xs_geo, ys_geo):
+            radar_data = self.plexe.get_radar_data(sumo_vehicle)
+            # speed and acceleration come with the subscription results, without additional TraCI calls
+            results = subscriptions[sumo_vehicle]
+            v = results[VAR_SPEED]
+            a = results[VAR_ACCEL]
+            # log velocita distanza radar e accelerazione
+            self.log_file.write(f"POS;{current_time};{sumo_vehicle};{x};{y};{x_geo};{y_geo}\n")
+            self.log_file.write(f"SPD;{current_time};{sumo_vehicle};{v};{a}\n")
+            self.log_file.write(f"DST;{current_time};{sumo_vehicle};{radar_data[RADAR_DISTANCE]}\n")
+            self.log_file.flush()
 
 
 def main():
@@ -402,6 +504,8 @@ def main():
     parser.add_argument("--time", help="Maximum simulation time in seconds", default=60, type=int)
     parser.add_argument("--gui", help="Use SUMO in GUI mode", action="store_true", default=False)
     parser.add_argument("--test", help="Run without Colosseum", action="store_true", default=False)
+    parser.add_argument("--batch-steps", help="Number of simulation steps covered by a single update to Colosseum",
+                        default=1, type=int)
     args = parser.parse_args()
     module, class_name = args.scenario.rsplit(".", 1)
     m = import_module(module)
@@ -425,16 +529,14 @@ def main():
         with open(args.params) as params_file:
             parameters = params_file.read()
     colossumo = Colossumo("sumo", broker, port, config, scenario, application, parameters,
-                          list(range(args.nodes)), gui, test)
+                          list(range(args.nodes)), gui, test, args.batch_steps)
     colossumo.connect_mqtt()
     colossumo.subscribe(COLOSSEUM_UPDATE_TOPIC)
-    attempt = 1
-    while not colossumo.is_connected() and attempt <= 10:
-        debug("Waiting to be connected to MQTT broker. Attempt {}".format(attempt))
-        attempt += 1
-        sleep(1)
-
-    if not colossumo.is_connected():
+    # a single wildcard subscription receives the API calls of all vehicles, the sender is taken from the topic
+    colossumo.subscribe(TOPIC_API_CALL.format(sumo_id="+"))
+    debug("Waiting to be connected to MQTT broker")
+    # wakes up as soon as the broker acknowledges the connection, instead of polling it every second
+    if not colossumo.connected_event.wait(timeout=10):
         error("Cannot connect to MQTT broker. Simulation will not start")
     else:
         debug("Connected to MQTT broker. Starting simulation")
@@ -25,4 +25,6 @@ TOPIC_API_CALL = f"{TOPIC_API_PREFIX}/{{sumo_id}}"
 TOPIC_API_RESPONSE = "apiresponse/{sumo_id}"
 # MQTT topic used to send data directly to other vehicles without using the communication stack
 TOPIC_DIRECT_COMM = "directcomm/{sumo_id}"
+# MQTT topic used to send data to a group of vehicles (e.g., a platoon) without using the communication stack
+TOPIC_GROUP_COMM = "groupcomm/{group_id}"
 
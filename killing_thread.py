@@ -28,3 +28,15 @@ class KillingThread(Thread):
             print(traceback.format_exc())
             print("Exeption in thread:", e, file=stderr)
             _exit(1)
+
+
+def kill_on_exception(future):
+    """ Callback to be added to futures submitted to an executor, to get the same behavior of KillingThread
+    """
+    if future.cancelled():
+        return
+    e = future.exception()
+    if e is not None:
+        print("".join(traceback.format_exception(e)))
+        print("Exeption in thread:", e, file=stderr)
+        _exit(1)
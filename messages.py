@@ -16,7 +16,27 @@
 #
 
 from json import dumps, loads
-from types import SimpleNamespace
+
+try:
+    # orjson is considerably faster than the json module of the standard library, so use it when available
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    # bytes can directly be published or sent, without decoding and encoding them again
+    json_dumpb = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj):
+        # no whitespace after separators, to keep packets as small as the ones produced by orjson
+        return dumps(obj, separators=(",", ":"))
+
+    def json_dumpb(obj):
+        return json_dumps(obj).encode()
+
+    json_loads = loads
+
 
 class MQTTUpdate:
     """ Class used to combine multiple messages and send them to colosseum
@@ -28,8 +48,28 @@ class MQTTUpdate:
     def add(self, message):
         self.messages.append(message.to_object())
 
+    def add_time(self, time):
+        """ Same as add(CurrentTimeMessage(time)), without building the message object
+        """
+        self.messages.append({"type": CurrentTimeMessage.TYPE, "content": {"time": time}})
+
+    def add_position(self, colosseum_id, x, y, crs=""):
+        """ Same as add(PositionUpdateMessage(colosseum_id, x, y, crs)), without building the message object. Used
+        for the position of each vehicle at every step
+        """
+        self.messages.append({"type": PositionUpdateMessage.TYPE,
+                              "content": {"colosseum_id": colosseum_id, "x": x, "y": y, "crs": crs}})
+
+    def clear(self):
+        """ Removes all the messages, so that the same object can be reused for the next update
+        """
+        self.messages.clear()
+
     def to_json(self):
-        return dumps({"type": self.type, "messages": self.messages})
+        """ Serializes the update
+        :return: the json document as bytes, ready to be published
+        """
+        return json_dumpb({"type": self.type, "messages": self.messages})
 
 
 class Message:
@@ -43,121 +83,165 @@ class Message:
             "y": 23.2,
         }
     }
+    Fields are only stored as attributes, the content is built from them when the message is serialized. Keys which are
+    not fields of the message (e.g., the recipient of a packet), either parsed or set with set_field(), are kept and
+    serialized as well
     """
+    # type of the message, to be set by inheriting classes
+    TYPE = ""
+    # names of the fields composing the content of the message, to be set by inheriting classes
+    FIELDS = ()
+    # same as FIELDS, as a set to check received messages. Computed for each message class
+    KEYS = frozenset()
+    # messages are created for every packet and every update, so attributes are stored in slots rather than in an
+    # instance dictionary
+    __slots__ = ("type", "parsed_content")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # the fields of each message class are fixed, so generate the functions converting them to and from the content
+        # with plain attribute accesses, which are considerably faster than iterating over FIELDS with getattr/setattr
+        fields = cls.FIELDS
+        cls.KEYS = frozenset(fields)
+        source = "def build_content(self):\n" \
+                 "    return {" + ", ".join(f'"{name}": self.{name}' for name in fields) + "}\n" \
+                 "def copy_fields(self, content):\n" + \
+                 "".join(f'    self.{name} = content["{name}"]\n' for name in fields) + \
+                 "    pass\n"
+        namespace = {}
+        exec(source, namespace)
+        cls.build_content = namespace["build_content"]
+        cls.copy_fields = namespace["copy_fields"]
+
     def __init__(self):
-        self.type = ""
-        self.content = {}
-        self.keys = []
+        self.type = self.TYPE
+        # content the message has been imported from, if any, including the keys set with set_field() which are not
+        # fields of the message
+        self.parsed_content = None
+
+    def build_content(self):
+        """ Builds the content of the message from its fields. Generated for each message class
+        """
+        return {}
+
+    def copy_fields(self, content):
+        """ Copies the fields of the message from the given content. Generated for each message class
+        """
+        pass
 
     def set_field(self, name, value):
-        setattr(self, name, value)
-        self.content[name] = value
+        if name in self.KEYS:
+            setattr(self, name, value)
+        elif self.parsed_content is None:
+            self.parsed_content = {name: value}
+        else:
+            # the parsed content might be shared with the caller of from_dict(), so it is copied rather than modified
+            self.parsed_content = {**self.parsed_content, name: value}
 
     def to_object(self):
+        content = self.build_content()
+        if self.parsed_content is not None:
+            # fields might have been changed after parsing, so they take precedence over the parsed values
+            content = {**self.parsed_content, **content}
         return {
             "type": self.type,
-            "content": self.content
+            "content": content
         }
 
     def to_json(self):
-        return dumps(self.to_object())
+        return json_dumps(self.to_object())
 
     def from_json(self, json):
-        parsed = loads(json, object_hook=lambda d: SimpleNamespace(**d))
-        if parsed.type != self.type:
+        # parsing into plain dictionaries avoids building a SimpleNamespace for each of them
+        return self.from_dict(json_loads(json))
+
+    def from_dict(self, parsed):
+        """ Same as from_json(), but for a message which has already been parsed into a dictionary
+        """
+        if parsed.get("type") != self.type:
             return False
         else:
-            self.content = parsed.content.__dict__
-            if not self.check_for_keys():
+            content = parsed["content"]
+            if not self.check_for_keys(content):
                 return False
-            self.from_object()
+            self.parsed_content = content
+            self.from_object(content)
             return True
 
-    def check_for_keys(self):
-        """ Checks that all object keys are present within self.content after importing from json
+    def check_for_keys(self, content):
+        """ Checks that all the fields of the message are present within the content imported from json
         """
-        for k in self.keys:
-            if k not in self.content.keys():
-                return False
-        return True
+        return self.KEYS.issubset(content)
 
-    def from_object(self):
-        """ To be implemented by inheriting classes to copy values from self.content to class variables after
-        importing data from json"""
-        pass
+    def from_object(self, content):
+        """ Copies values from the content imported from json to class variables. Inheriting classes can extend it to
+        convert values"""
+        self.copy_fields(content)
 
 
 class CurrentTimeMessage(Message):
     """ Message to be sent to colosseum to indicate current simulation time
     """
+    TYPE = "time"
+    FIELDS = ("time",)
+    __slots__ = FIELDS
+
     def __init__(self, time=None):
         super().__init__()
-        self.type = "time"
         self.time = time
-        self.content = {"time": self.time}
-        self.keys = self.content.keys()
-
-    def from_object(self):
-        self.time = self.content["time"]
 
 
 class NewVehicleMessage(Message):
     """ Message to be sent to colosseum to notify about the creation of a new vehicle and the mapping with the node
     """
+    TYPE = "new_vehicle"
+    FIELDS = ("sumo_id", "colosseum_id", "application", "parameters")
+    __slots__ = FIELDS
+
     def __init__(self, sumo_id=None, colosseum_id=None, application=None, parameters=None):
         super().__init__()
-        self.type = "new_vehicle"
         self.sumo_id = sumo_id
         self.colosseum_id = colosseum_id
         self.application = application
         self.parameters = parameters
-        self.content = {"sumo_id": self.sumo_id, "colosseum_id": self.colosseum_id, "application": self.application,
-                        "parameters": self.parameters}
-        self.keys = self.content.keys()
-
-    def from_object(self):
-        self.sumo_id = self.content["sumo_id"]
-        self.colosseum_id = self.content["colosseum_id"]
-        self.application = self.content["application"]
-        self.parameters = self.content["parameters"]
-        self.timestamp = self.content["timestamp"]
 
 
 class DeleteVehicleMessage(NewVehicleMessage):
     """ Message to be sent to colosseum to notify about the deletion of a vehicle
     """
+    TYPE = "delete_vehicle"
+    __slots__ = ()
+
     def __init__(self, sumo_id=None, colosseum_id=None):
         super().__init__(sumo_id, colosseum_id)
-        self.type = "delete_vehicle"
 
 
 class PositionUpdateMessage(Message):
     """ Message to be sent to colosseum to notify about the change in position of a vehicle
     """
+    TYPE = "update_position"
+    FIELDS = ("colosseum_id", "x", "y", "crs")
+    __slots__ = FIELDS
+
     def __init__(self, colosseum_id=None, x=None, y=None, crs=""):
         super().__init__()
-        self.type = "update_position"
         self.colosseum_id = colosseum_id
         self.x = x
         self.y = y
         self.crs = crs
-        self.content = {"colosseum_id": self.colosseum_id, "x": self.x, "y": self.y, "crs": self.crs}
-        self.keys = self.content.keys()
-
-    def from_object(self):
-        self.colosseum_id = self.content["colosseum_id"]
-        self.x = self.content["x"]
-        self.y = self.content["y"]
 
 
 class VehicleDataMessage(Message):
     """ Message used to fetch vehicle data from SUMO by a colosseum node or to set data about another vehicle when a
     packet is received
     """
+    TYPE = "vehicle_data"
+    FIELDS = ("sumo_id", "controller_acceleration", "acceleration", "speed", "time", "x", "y", "sender", "seqn", "ts")
+    __slots__ = FIELDS
+
     def __init__(self, sumo_id=None, controller_acceleration=None, acceleration=None, speed=None, time=None, x=None,
                  y=None, sender="", seqn=None, ts=None):
         super().__init__()
-        self.type = "vehicle_data"
         self.sumo_id = sumo_id
         self.controller_acceleration = controller_acceleration
         self.acceleration = acceleration
@@ -168,108 +252,55 @@ class VehicleDataMessage(Message):
         self.sender = sender
         self.seqn = seqn
         self.ts = ts
-        self.content = {
-            "sumo_id": self.sumo_id,
-            "controller_acceleration": self.controller_acceleration,
-            "acceleration": self.acceleration,
-            "speed": self.speed,
-            "time": self.time,
-            "x": self.x,
-            "y": self.y,
-            "sender": self.sender,
-            "seqn": self.seqn,
-            "ts": self.ts,
-        }
-        self.keys = self.content.keys()
-
-    def from_object(self):
-        self.sumo_id = self.content["sumo_id"]
-        self.controller_acceleration = self.content["controller_acceleration"]
-        self.acceleration = self.content["acceleration"]
-        self.speed = self.content["speed"]
-        self.time = self.content["time"]
-        self.x = self.content["x"]
-        self.y = self.content["y"]
-        self.sender = self.content["sender"]
-        self.seqn = self.content["seqn"]
-        self.ts = self.content["ts"]
 
 
 class StartSimulationMessage(Message):
     """ Message sent from colosseum to inform we can start moving the vehicles in SUMO
     """
     TYPE = "start_simulation"
-
-    def __init__(self):
-        super().__init__()
-        self.type = StartSimulationMessage.TYPE
-        self.content = {
-        }
-        self.keys = self.content.keys()
+    __slots__ = ()
 
 
 class StopSimulationMessage(Message):
     """ Message sent from colosseum to stop the simulation
     """
     TYPE = "stop_simulation"
-
-    def __init__(self):
-        super().__init__()
-        self.type = StopSimulationMessage.TYPE
-        self.content = {
-        }
-        self.keys = self.content.keys()
+    __slots__ = ()
 
 
 class APICallMessage(Message):
     """ Message sent from colosseum to invoke an API
     """
     TYPE = "api_call"
+    FIELDS = ("sumo_id", "api_code", "transaction_id", "parameters")
+    __slots__ = FIELDS
 
     def __init__(self, sumo_id=None, api_code=None, transaction_id=None, parameters=None):
         super().__init__()
-        self.type = APICallMessage.TYPE
         self.sumo_id = sumo_id
         self.api_code = api_code
         self.transaction_id = transaction_id
         self.parameters = parameters
-        self.content = {
-            "sumo_id": sumo_id,
-            "api_code": api_code,
-            "transaction_id": transaction_id,
-            "parameters": parameters
-        }
-        self.keys = self.content.keys()
 
-    def from_object(self):
-        self.sumo_id = self.content["sumo_id"]
-        self.api_code = self.content["api_code"]
-        self.transaction_id = int(self.content["transaction_id"])
-        self.parameters = self.content["parameters"]
+    def from_object(self, content):
+        super().from_object(content)
+        self.transaction_id = int(self.transaction_id)
 
 
 class APIResponseMessage(Message):
     """ Message sent from Colossumo to Colosseum to return the response of a remote call
     """
     TYPE = "api_return"
+    FIELDS = ("sumo_id", "api_code", "transaction_id", "response")
+    __slots__ = FIELDS
 
     def __init__(self, sumo_id=None, api_code=None, transaction_id=None, response=None):
         super().__init__()
-        self.type = APIResponseMessage.TYPE
         self.sumo_id = sumo_id
         self.api_code = api_code
         self.transaction_id = transaction_id
         self.response = response
-        self.content = {
-            "sumo_id": sumo_id,
-            "api_code": api_code,
-            "transaction_id": transaction_id,
-            "response": response
-        }
-        self.keys = self.content.keys()
 
-    def from_object(self):
-        self.sumo_id = self.content["sumo_id"]
-        self.api_code = self.content["api_code"]
-        self.transaction_id = int(self.content["transaction_id"])
-        self.response = self.content["response"]
+    def from_object(self, content):
+        super().from_object(content)
+        self.transaction_id = int(self.transaction_id)
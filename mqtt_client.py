@@ -16,8 +16,21 @@
 #
 
 from logging import error, debug, DEBUG, basicConfig
+from threading import Event
+import socket
 import paho.mqtt.client as mqtt
 
+# quality of service of all publications and subscriptions. Everything travels on a local network and API calls are
+# already answered by a response, so there is no need for the additional PUBACK round trips of higher levels
+MQTT_QOS = 0
+
+
+def configure_socket(client, userdata, sock):
+    """ Callback invoked by paho when the socket towards the broker is opened. Disables Nagle's algorithm, which would
+    otherwise delay small messages (such as API calls and their responses) by up to 40 ms
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
 
 class MQTTClient:
     def __init__(self, client_id, broker, port):
@@ -30,11 +43,14 @@ class MQTTClient:
         self.broker = broker
         self.port = port
         self.client = None
+        # set once the connection to the broker has been established
+        self.connected_event = Event()
 
     def __on_connect(self, client, userdata, flags, rc, properties):
         if rc == 0:
             debug("Connected to MQTT Broker!")
             self.on_connect()
+            self.connected_event.set()
         else:
             error("Failed to connect, return code %d\n", rc)
 
@@ -47,6 +63,8 @@ class MQTTClient:
         self.client = client
         client.username_pw_set("user", "pwd")
         client.on_connect = self.__on_connect
+        client.on_socket_open = configure_socket
+        client.on_message = self.on_message
         client.connect(self.broker, self.port)
         client.loop_start()
 
@@ -56,7 +74,7 @@ class MQTTClient:
             self.client.disconnect()
 
     def publish(self, topic, data):
-        result = self.client.publish(topic, data)
+        result = self.client.publish(topic, data, qos=MQTT_QOS, retain=False)
         # result: [0, 1]
         status = result[0]
         return status == 0
@@ -66,8 +84,7 @@ class MQTTClient:
         pass
 
     def subscribe(self, topic):
-        self.client.subscribe(topic)
-        self.client.on_message = self.on_message
+        self.client.subscribe(topic, qos=MQTT_QOS)
 
     def is_connected(self):
         return self.client.is_connected()
@@ -0,0 +1,171 @@
+#
+# Copyright (c) 2024 Michele Segata <segata@ccs-labs.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+""" Helpers to send or receive several UDP datagrams with a single system call. The python socket module does not
+expose sendmmsg(2) and recvmmsg(2), so they are invoked through ctypes. Where they are not available (e.g., not on
+Linux), datagrams are sent one by one with sendto() and received one by one with recv()
+"""
+import ctypes
+import ctypes.util
+import socket
+import struct
+from errno import EINTR
+from functools import lru_cache
+from os import strerror
+
+# recvmmsg() flag making the call return as soon as at least one datagram has been received
+MSG_WAITFORONE = 0x10000
+# size of the kernel buffers of the udp sockets, large enough to absorb a burst of packets
+UDP_BUFFER_SIZE = 1 << 20
+# maximum number of datagrams fetched from a udp socket with a single system call, shared by all the receivers
+UDP_RECEIVE_BATCH = 32
+# maximum size of a received datagram
+UDP_MAX_DATAGRAM = 2048
+# maximum number of destinations whose sockaddr_in structure is kept, enough for all the nodes of a simulation
+SOCKADDR_CACHE_SIZE = 256
+
+
+class IOVec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", MsgHdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+def _load_libc_function(name, argtypes):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        function = getattr(libc, name)
+    except (OSError, AttributeError, TypeError):
+        return None
+    function.argtypes = argtypes
+    function.restype = ctypes.c_int
+    return function
+
+
+_sendmmsg = _load_libc_function("sendmmsg", [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int])
+_recvmmsg = _load_libc_function("recvmmsg", [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                             ctypes.c_void_p])
+
+
+@lru_cache(maxsize=SOCKADDR_CACHE_SIZE)
+def _sockaddr(address):
+    # destinations are usually the same for every call, so the structures are cached, but only for a bounded number of
+    # them
+    host, port = address
+    raw = struct.pack("=H", socket.AF_INET) + struct.pack("!H", port) + \
+        socket.inet_aton(socket.gethostbyname(host)) + bytes(8)
+    return ctypes.create_string_buffer(raw, len(raw))
+
+
+def sendmmsg(sock, datagrams):
+    """ Sends a list of datagrams through an AF_INET UDP socket, using a single sendmmsg system call when possible
+    :param sock: socket to be used for sending the datagrams
+    :param datagrams: list of (payload, (host, port)) tuples, where payload is a bytes object
+    """
+    if _sendmmsg is None:
+        for payload, address in datagrams:
+            sock.sendto(payload, address)
+        return
+    n = len(datagrams)
+    if n == 0:
+        return
+    messages = (MMsgHdr * n)()
+    iovecs = (IOVec * n)()
+    # keep references to the buffers and to the addresses, which might be evicted from the cache, until the system
+    # call returns
+    buffers = []
+    for i, (payload, address) in enumerate(datagrams):
+        buffer = ctypes.c_char_p(payload)
+        sockaddr = _sockaddr(address)
+        buffers.append(buffer)
+        buffers.append(sockaddr)
+        iovecs[i].iov_base = ctypes.cast(buffer, ctypes.c_void_p)
+        iovecs[i].iov_len = len(payload)
+        header = messages[i].msg_hdr
+        header.msg_name = ctypes.cast(sockaddr, ctypes.c_void_p)
+        header.msg_namelen = len(sockaddr)
+        header.msg_iov = ctypes.pointer(iovecs[i])
+        header.msg_iovlen = 1
+    sent = 0
+    fd = sock.fileno()
+    while sent < n:
+        result = _sendmmsg(fd, ctypes.addressof(messages[sent]), n - sent, 0)
+        if result < 0:
+            error_code = ctypes.get_errno()
+            # retry when interrupted by a signal, as done when receiving
+            if error_code != EINTR:
+                raise OSError(error_code, strerror(error_code))
+            continue
+        sent += result
+
+
+class BatchReceiver:
+    """ Receives datagrams from a UDP socket, fetching all the ones already queued with a single recvmmsg system call.
+    Buffers are allocated once and reused for every call
+    """
+    def __init__(self, sock, count, size):
+        """ Initializer method
+        :param sock: socket to receive datagrams from
+        :param count: maximum number of datagrams fetched with a single system call
+        :param size: maximum size of a datagram
+        """
+        self.sock = sock
+        self.count = count
+        self.size = size
+        self.buffers = [ctypes.create_string_buffer(size) for _ in range(count)]
+        self.iovecs = (IOVec * count)()
+        self.messages = (MMsgHdr * count)()
+        for i in range(count):
+            self.iovecs[i].iov_base = ctypes.cast(self.buffers[i], ctypes.c_void_p)
+            self.iovecs[i].iov_len = size
+            self.messages[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.messages[i].msg_hdr.msg_iovlen = 1
+
+    def receive(self):
+        """ Blocks until at least one datagram is available
+        :return: list of the payloads (as bytes objects) of the received datagrams
+        """
+        if _recvmmsg is None:
+            return [self.sock.recv(self.size)]
+        fd = self.sock.fileno()
+        while True:
+            result = _recvmmsg(fd, self.messages, self.count, MSG_WAITFORONE, None)
+            if result >= 0:
+                break
+            error_code = ctypes.get_errno()
+            if error_code != EINTR:
+                raise OSError(error_code, strerror(error_code))
+        return [self.buffers[i].raw[:self.messages[i].msg_len] for i in range(result)]
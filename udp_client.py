@@ -17,9 +17,9 @@
 
 from logging import error, debug, DEBUG, basicConfig
 from killing_thread import KillingThread
-from messages import VehicleDataMessage
+from messages import VehicleDataMessage, json_loads
+from udp_batch import BatchReceiver, sendmmsg, UDP_BUFFER_SIZE, UDP_RECEIVE_BATCH, UDP_MAX_DATAGRAM
 import socket
-import json
 
 
 class UDPClient:
@@ -37,32 +37,35 @@ class UDPClient:
     def init_udp(self):
         #server socket
         self.udp_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER_SIZE)
         self.udp_server.bind(('0.0.0.0', self.port))
         self.udp_thread = KillingThread(target=self.udp_worker)
         self.udp_thread.start()
         
-        #client sockets #TODO: do we need multiple? probably not since they are statless
-        self.udp_sockets = {}
-        for a in self.addresses:
-            tx_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.udp_sockets[a] = tx_socket
+        # client socket. UDP is stateless, so a single socket can send to all the destinations
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_BUFFER_SIZE)
+        # (address, port) of all the destinations of broadcast packets
+        self.udp_destinations = [(addr, self.port) for addr in self.addresses]
 
     def udp_worker(self):
         debug("Started UDP Server")
+        receiver = BatchReceiver(self.udp_server, UDP_RECEIVE_BATCH, UDP_MAX_DATAGRAM)
         while True:
-            blob, addr = self.udp_server.recvfrom(2014)
-            data = json.loads(blob)
-            message = VehicleDataMessage()
-            if message.from_json(blob):
-                self.receive(data['content']['sender'], message)
+            for blob in receiver.receive():
+                # parse the datagram only once, with orjson when available
+                message = VehicleDataMessage()
+                if message.from_dict(json_loads(blob)):
+                    self.receive(message.sender, message)
 
     def udp_broadcast(self, data):
-        for addr in self.udp_sockets.keys():
-            self.udp_unicast(data, addr)
+        # the same payload is sent to all the addresses with a single system call, and it is encoded only if needed
+        payload = data.encode('utf-8') if isinstance(data, str) else data
+        sendmmsg(self.udp_socket, [(payload, destination) for destination in self.udp_destinations])
     
     def udp_unicast(self, data, addr):
-        payload = data.encode('utf-8')
-        self.udp_sockets[addr].sendto(payload, (addr, self.port))
+        payload = data.encode('utf-8') if isinstance(data, str) else data
+        self.udp_socket.sendto(payload, (addr, self.port))
     
     def receive(self, source, packet):
         """ Callback invoked by Colosseum when a packet for this vehicle has been received. This method should be
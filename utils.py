@@ -118,14 +118,14 @@ def communicate(plexe, topology):
     which includes the keys "leader" and "front"
     """
     for vid, l in topology.items():
-        if "leader" in l.keys():
+        if "leader" in l:
             # get data about platoon leader
             ld = plexe.get_vehicle_data(l["leader"])
             # pass leader vehicle data to CACC
             plexe.set_leader_vehicle_data(vid, ld)
             # pass data to the fake CACC as well, in case it's needed
             plexe.set_leader_vehicle_fake_data(vid, ld)
-        if "front" in l.keys():
+        if "front" in l:
             # get data about platoon leader
             fd = plexe.get_vehicle_data(l["front"])
             # pass front vehicle data to CACC
@@ -182,7 +182,7 @@ def get_status(status):
     for i in range(32):
         mask = 1 << i
         if status & mask:
-            if mask in bits.keys():
+            if mask in bits:
                 st += " " + bits[mask]
             else:
                 st += " 2^" + str(i)